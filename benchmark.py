@@ -0,0 +1,124 @@
+import argparse
+import shutil
+import time
+
+import cv2
+import numpy as np
+
+from main import (capture_key_frames, capture_key_frames_klt, list_key_frames, neighbor_match_mask,
+                  optimize_key_frames, stitch_images_all_at_once, stitch_images_cylindrical,
+                  stitch_images_neighbors)
+
+
+def time_engine(stitch_fn, frames, repeat):
+    """Run a stitch function `repeat` times; returns (timings, succeeded)"""
+    timings = []
+    succeeded = True
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pano = stitch_fn(frames)
+        timings.append(time.perf_counter() - start)
+        succeeded = succeeded and pano is not None
+    return timings, succeeded
+
+
+def match_scaling(video_path, counts, neighbors, frame_step=10, work_megapix=0.6):
+    """Time all-pairs vs neighbour-restricted matching for growing numbers of frames"""
+    # Sample evenly spaced frames so every count has an ordered, overlapping sequence
+    vid_cap = cv2.VideoCapture(video_path)
+    finder = cv2.ORB_create()
+    features = []
+    index = 0
+    while len(features) < max(counts):
+        success, image = vid_cap.read()
+        if not success:
+            break
+        if index % frame_step == 0:
+            height, width = image.shape[:2]
+            work_scale = min(1.0, np.sqrt(work_megapix * 1e6 / (width * height)))
+            image = cv2.resize(image, None, fx=work_scale, fy=work_scale, interpolation=cv2.INTER_LINEAR_EXACT)
+            features.append(cv2.detail.computeImageFeatures2(finder, image))
+        index += 1
+    vid_cap.release()
+
+    matcher = cv2.detail_BestOf2NearestMatcher(False, 0.3)
+    rows = []
+    for n in counts:
+        if n > len(features):
+            break
+        all_pairs = np.ones((n, n), np.uint8) - np.eye(n, dtype=np.uint8)
+        timings = []
+        for mask in (all_pairs, neighbor_match_mask(n, neighbors)):
+            start = time.perf_counter()
+            matcher.apply2(features[:n], mask)
+            timings.append(time.perf_counter() - start)
+            matcher.collectGarbage()
+        rows.append((n, int(all_pairs.sum() // 2), *timings))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark stitching engines on key frames captured from a video')
+    parser.add_argument('video', help='Input video file path')
+    parser.add_argument('--temp_dir', default='bench_frames', help='Directory for storing temporary key frames')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per engine')
+    parser.add_argument('--neighbors', type=int, default=2, help='Temporal neighbours for the neighbors engine')
+    parser.add_argument('--scaling', action='store_true',
+                        help='Also time pairwise matching against the number of key frames')
+    args = parser.parse_args()
+
+    # Key frame selection: SIFT on every sampled frame vs KLT tracking
+    selectors = {
+        'sift': capture_key_frames,
+        'klt': capture_key_frames_klt,
+    }
+    selection = {}
+    for name, capture_fn in selectors.items():
+        print(f"\nBenchmarking {name} key frame selection...")
+        shutil.rmtree(args.temp_dir, ignore_errors=True)
+        start = time.perf_counter()
+        count = capture_fn(args.video, args.temp_dir)
+        selection[name] = (time.perf_counter() - start, count)
+
+    # Stitching engines run on the key frames of the default SIFT selector
+    shutil.rmtree(args.temp_dir, ignore_errors=True)
+    capture_key_frames(args.video, args.temp_dir)
+    frames = list_key_frames(args.temp_dir)
+
+    engines = {
+        'stitcher': stitch_images_all_at_once,
+        'cylindrical': stitch_images_cylindrical,
+        'neighbors': lambda frames: stitch_images_neighbors(frames, neighbors=args.neighbors),
+        # Optimizer cost is included so the row shows the net saving
+        'stitcher+opt': lambda frames: stitch_images_all_at_once(optimize_key_frames(frames)),
+    }
+    results = {}
+    for name, stitch_fn in engines.items():
+        print(f"\nBenchmarking {name} engine...")
+        results[name] = time_engine(stitch_fn, frames, args.repeat)
+
+    shutil.rmtree(args.temp_dir)
+
+    print(f"\n{'selector':<12} {'time (s)':>9} {'frames':>7}")
+    for name, (elapsed, count) in selection.items():
+        print(f"{name:<12} {elapsed:>9.2f} {count:>7}")
+
+    baseline = min(results['stitcher'][0])
+    print(f"\n{len(frames)} key frames, {args.repeat} runs per engine")
+    print(f"{'engine':<12} {'best (s)':>9} {'mean (s)':>9} {'speedup':>8}  status")
+    for name, (timings, succeeded) in results.items():
+        best = min(timings)
+        mean = sum(timings) / len(timings)
+        status = 'ok' if succeeded else 'failed'
+        print(f"{name:<12} {best:>9.2f} {mean:>9.2f} {baseline / best:>7.1f}x  {status}")
+
+    if args.scaling:
+        print("\nTiming pairwise matching against key frame count...")
+        rows = match_scaling(args.video, [4, 8, 16, 24, 32], args.neighbors)
+        print(f"\n{'frames':>6} {'pairs':>6} {'all pairs (s)':>14} {f'{args.neighbors} neighbours (s)':>17}")
+        for n, pairs, all_time, neighbor_time in rows:
+            print(f"{n:>6} {pairs:>6} {all_time:>14.2f} {neighbor_time:>17.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,26 +6,38 @@ import shutil
 import time
 import copy
 
-def capture_key_frames(video_path, output_dir='key_frames'):
+from thread_budget import ThreadBudget, positive_int
+
+# Choices shared by the command line and the worker
+ENGINES = ['stitcher', 'cylindrical', 'auto', 'neighbors']
+SELECTORS = ['sift', 'klt']
+
+def capture_key_frames(video_path, output_dir='key_frames', sift=None, budget=None, progress=print,
+                       cancel_event=None):
     # Ensure output directory exists
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
-    # Create VideoCapture object to get video stream
-    vid_cap = cv2.VideoCapture(video_path)
+    # Create VideoCapture object to get video stream, decoding with the budgeted threads
+    if budget is None:
+        budget = ThreadBudget()
+    vid_cap = budget.open_video(video_path)
     
     # Get total frame count and frame rate
     total_frames = int(vid_cap.get(cv2.CAP_PROP_FRAME_COUNT))
     fps = vid_cap.get(cv2.CAP_PROP_FPS)
-    print(f"Total frames: {total_frames}, Frame rate: {fps}")
+    progress(f"Total frames: {total_frames}, Frame rate: {fps}")
 
     # Use SIFT descriptors to describe overlap areas between current and adjacent frames
-    sift = cv2.SIFT_create()
+    # (a long-running worker passes in a detector it keeps warm)
+    if sift is None:
+        sift = cv2.SIFT_create()
 
     # Select the first frame as key frame by default
-    success, last = vid_cap.read()
+    with budget.stage('decode'):
+        success, last = vid_cap.read()
     cv2.imwrite(f'{output_dir}/frame0.jpg', last)
-    print("Captured frame0.jpg")
+    progress("Captured frame0.jpg")
     count = 1
     frame_num = 1
 
@@ -39,20 +51,27 @@ def capture_key_frames(video_path, output_dir='key_frames'):
     last_capture_frame = 0
 
     # Read next frame
-    success, image = vid_cap.read()
+    with budget.stage('decode'):
+        success, image = vid_cap.read()
     
     while success:
+        # Stop early when the caller cancels; frames captured so far stay on disk
+        if cancel_event is not None and cancel_event.is_set():
+            progress("Key frame capture cancelled")
+            break
+        
         # Display processing progress
         if count % 50 == 0:
-            print(f"Processing progress: {count}/{total_frames} ({count/total_frames*100:.1f}%)")
+            progress(f"Processing progress: {count}/{total_frames} ({count/total_frames*100:.1f}%)")
             
         force_capture = (count - last_capture_frame >= force_capture_interval)
         
         if count % step == 0:
             try:
                 # Detect and compute keypoints and descriptors
-                kp1, des1 = sift.detectAndCompute(last[:, -w:], None)
-                kp2, des2 = sift.detectAndCompute(image[:, :w], None)
+                with budget.stage('features'):
+                    kp1, des1 = sift.detectAndCompute(last[:, -w:], None)
+                    kp2, des2 = sift.detectAndCompute(image[:, :w], None)
                 
                 capture_this_frame = False
                 inliers = 0
@@ -60,7 +79,8 @@ def capture_key_frames(video_path, output_dir='key_frames'):
                 if des1 is not None and des2 is not None and len(des1) > 0 and len(des2) > 0:
                     # Use brute force matcher to get matches
                     bf = cv2.BFMatcher(normType=cv2.NORM_L2)
-                    matches = bf.knnMatch(des1, des2, k=2)
+                    with budget.stage('features'):
+                        matches = bf.knnMatch(des1, des2, k=2)
                     
                     if len(matches) > 0:
                         # Define valid match: distance less than match_ratio times the distance of the second best match
@@ -103,43 +123,201 @@ def capture_key_frames(video_path, output_dir='key_frames'):
                 if capture_this_frame:
                     # Save key frame as JPG file
                     last = image.copy()
-                    print(f"Captured frame{frame_num}.jpg")
+                    progress(f"Captured frame{frame_num}.jpg")
                     cv2.imwrite(f'{output_dir}/frame{frame_num}.jpg', last)
                     frame_num += 1
                     last_capture_frame = count
                     
             except Exception as e:
-                print(f"Error processing frame {count}: {e}")
+                progress(f"Error processing frame {count}: {e}")
         
-        success, image = vid_cap.read()
+        with budget.stage('decode'):
+            success, image = vid_cap.read()
         count += 1
     
-    print(f"Processing complete. Captured {frame_num} key frames.")
+    progress(f"Processing complete. Captured {frame_num} key frames.")
     vid_cap.release()
     return frame_num
 
 
 
-def stitch_images_all_at_once(image_paths):
+def frame_overlap(H, width, height):
+    """Fraction of a frame still covered after mapping its corners through H"""
+    corners = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    proj = cv2.perspectiveTransform(corners.reshape(-1, 1, 2), H).reshape(-1, 2)
+    area, _ = cv2.intersectConvexConvex(corners, proj)
+    return area / (width * height)
+
+def capture_key_frames_klt(video_path, output_dir='key_frames', sift=None, track_step=5, track_scale=0.5,
+                           min_overlap=0.5, min_inliers=50, min_match_num=100, force_capture_interval=100,
+                           budget=None, progress=print, cancel_event=None):
+    """Select key frames by tracking corners from the last key frame with pyramidal
+    Lucas-Kanade flow; SIFT is only used to re-acquire the key frame when tracking is lost"""
+    # Ensure output directory exists
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    
+    if budget is None:
+        budget = ThreadBudget()
+    vid_cap = budget.open_video(video_path)
+    total_frames = int(vid_cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = vid_cap.get(cv2.CAP_PROP_FPS)
+    progress(f"Total frames: {total_frames}, Frame rate: {fps}")
+    
+    def to_gray(frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, None, fx=track_scale, fy=track_scale, interpolation=cv2.INTER_AREA)
+    
+    def detect_corners(gray):
+        pts = cv2.goodFeaturesToTrack(gray, maxCorners=500, qualityLevel=0.01, minDistance=8)
+        return pts if pts is not None else np.empty((0, 1, 2), np.float32)
+    
+    # Select the first frame as key frame by default
+    with budget.stage('decode'):
+        success, image = vid_cap.read()
+    if not success:
+        progress(f"Cannot read video: {video_path}")
+        vid_cap.release()
+        return 0
+    cv2.imwrite(f'{output_dir}/frame0.jpg', image)
+    progress("Captured frame0.jpg")
+    frame_num = 1
+    
+    key_gray = to_gray(image)
+    height, width = key_gray.shape
+    key_pts = detect_corners(key_gray)  # Positions in the key frame
+    prev_pts = key_pts.copy()           # Same points tracked into the previous sampled frame
+    prev_gray = key_gray
+    key_sift = None  # SIFT keypoints/descriptors of the key frame, computed on first re-acquisition
+    last_overlap = 1.0
+    last_capture_frame = 0
+    reacquired = 0
+    count = 1
+    
+    while True:
+        if cancel_event is not None and cancel_event.is_set():
+            progress("Key frame capture cancelled")
+            break
+        
+        # Only sampled frames are retrieved; the others are just grabbed
+        with budget.stage('decode'):
+            if count % track_step != 0:
+                success = vid_cap.grab()
+                image = None
+            else:
+                success, image = vid_cap.read()
+        if not success:
+            break
+        if image is None:
+            count += 1
+            continue
+        
+        # Display processing progress
+        if count % 50 == 0:
+            progress(f"Processing progress: {count}/{total_frames} ({count/total_frames*100:.1f}%)")
+        
+        with budget.stage('features'):
+            gray = to_gray(image)
+            overlap = 0.0
+            inliers = 0
+            if len(prev_pts) >= 8:
+                next_pts, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, prev_pts, None,
+                                                               winSize=(21, 21), maxLevel=3)
+                tracked = status.ravel() == 1
+                key_pts, prev_pts = key_pts[tracked], next_pts[tracked]
+                if len(prev_pts) >= 8:
+                    H, mask = cv2.findHomography(key_pts, prev_pts, cv2.RANSAC, 3.0)
+                    if H is not None:
+                        inliers = np.count_nonzero(mask)
+                        overlap = frame_overlap(H, width, height)
+                        # Outliers would only corrupt later estimates
+                        keep = mask.ravel() == 1
+                        key_pts, prev_pts = key_pts[keep], prev_pts[keep]
+            
+            capture_this_frame = False
+            # `overlap` is 0 when tracking is lost, so decide on the last overlap that was measured
+            if inliers < min_inliers and last_overlap > min_overlap:
+                # Tracking was lost (blur, occlusion) while the view may still overlap:
+                # re-acquire correspondences with SIFT instead of capturing straight away
+                if sift is None:
+                    sift = cv2.SIFT_create()
+                if key_sift is None:
+                    key_sift = sift.detectAndCompute(key_gray, None)
+                kp1, des1 = key_sift
+                overlap, inliers = 0.0, 0
+                # A featureless key frame cannot be re-acquired, so skip detecting on this frame
+                if des1 is not None and len(des1) >= 2:
+                    kp2, des2 = sift.detectAndCompute(gray, None)
+                else:
+                    kp2, des2 = [], None
+                if des1 is not None and des2 is not None and len(des1) >= 2 and len(des2) >= 2:
+                    bf = cv2.BFMatcher(normType=cv2.NORM_L2)
+                    good = [m[0] for m in bf.knnMatch(des1, des2, k=2)
+                            if len(m) == 2 and m[0].distance < 0.8 * m[1].distance]
+                    if len(good) > 4:
+                        src = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1, 1, 2)
+                        dst = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
+                        H, mask = cv2.findHomography(src, dst, cv2.RANSAC, 3.0)
+                        if H is not None and np.count_nonzero(mask) >= min_match_num:
+                            keep = mask.ravel() == 1
+                            key_pts, prev_pts = src[keep], dst[keep]
+                            inliers = len(key_pts)
+                            overlap = frame_overlap(H, width, height)
+                            reacquired += 1
+                if inliers >= min_match_num:
+                    capture_this_frame = overlap <= min_overlap
+                else:
+                    # Low texture or a cut: like the SIFT selector, keep the key frame until the
+                    # force-capture interval has passed instead of capturing every sampled frame
+                    capture_this_frame = count - last_capture_frame >= force_capture_interval
+                    overlap = last_overlap
+            elif inliers < min_inliers or overlap <= min_overlap:
+                capture_this_frame = True
+        
+        if capture_this_frame:
+            # Save key frame and restart tracking from freshly detected corners
+            progress(f"Captured frame{frame_num}.jpg")
+            cv2.imwrite(f'{output_dir}/frame{frame_num}.jpg', image)
+            frame_num += 1
+            key_gray = gray
+            key_sift = None
+            with budget.stage('features'):
+                key_pts = detect_corners(gray)
+            prev_pts = key_pts.copy()
+            overlap = 1.0
+            last_capture_frame = count
+        
+        prev_gray = gray
+        last_overlap = overlap
+        count += 1
+    
+    progress(f"Processing complete. Captured {frame_num} key frames ({reacquired} SIFT re-acquisitions).")
+    vid_cap.release()
+    return frame_num
+
+def stitch_images_all_at_once(image_paths, scale=1.0, progress=print):
 
     # Read all images
     images = []
     for path in image_paths:
         img = cv2.imread(path)
         if img is None:
-            print(f"Cannot read image: {path}")
+            progress(f"Cannot read image: {path}")
             continue
+        # Downscale for a fast low-resolution preview
+        if scale < 1.0:
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
         images.append(img)
     
     if len(images) < 2:
-        print("At least two images are required for stitching")
+        progress("At least two images are required for stitching")
         return None
     
     # Create stitcher
     stitcher = cv2.Stitcher.create(cv2.Stitcher_PANORAMA)
     
     # Perform stitching
-    print(f"Starting to stitch {len(images)} images at once...")
+    progress(f"Starting to stitch {len(images)} images at once...")
     status, pano = stitcher.stitch(images)
     
     if status != cv2.Stitcher_OK:
@@ -148,11 +326,447 @@ def stitch_images_all_at_once(image_paths):
             cv2.Stitcher_ERR_HOMOGRAPHY_EST_FAIL: "Homography estimation failed",
             cv2.Stitcher_ERR_CAMERA_PARAMS_ADJUST_FAIL: "Camera parameter adjustment failed"
         }
-        print(f"Stitching failed: {error_messages.get(status, f'Unknown error {status}')}")
+        progress(f"Stitching failed: {error_messages.get(status, f'Unknown error {status}')}")
         return None
     
     return pano
 
+def neighbor_match_mask(num_images, neighbors=2, grid_cols=None):
+    """Pairs worth matching: each frame with its `neighbors` temporal successors, or for
+    2D scans captured row by row in a serpentine grid, the frames adjacent in the grid"""
+    mask = np.zeros((num_images, num_images), np.uint8)
+    if grid_cols:
+        # Grid cell of every frame; odd rows run right to left
+        cells = []
+        for i in range(num_images):
+            row, col = divmod(i, grid_cols)
+            cells.append((row, grid_cols - 1 - col if row % 2 else col))
+        for i in range(num_images):
+            for j in range(i + 1, num_images):
+                if max(abs(cells[i][0] - cells[j][0]), abs(cells[i][1] - cells[j][1])) <= 1:
+                    mask[i, j] = mask[j, i] = 1
+    else:
+        for i in range(num_images):
+            for j in range(i + 1, min(i + neighbors, num_images - 1) + 1):
+                mask[i, j] = mask[j, i] = 1
+    return mask
+
+def stitch_images_neighbors(image_paths, scale=1.0, neighbors=2, grid_cols=None,
+                            work_megapix=0.6, seam_megapix=0.1, conf_thresh=1.0, progress=print):
+    """Same pipeline as cv2.Stitcher_PANORAMA, but key frames are only matched with their
+    temporal (or grid) neighbours instead of every other key frame"""
+    images = []
+    for path in image_paths:
+        img = cv2.imread(path)
+        if img is None:
+            progress(f"Cannot read image: {path}")
+            continue
+        if scale < 1.0:
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        images.append(img)
+    
+    if len(images) < 2:
+        progress("At least two images are required for stitching")
+        return None
+    
+    progress(f"Starting to stitch {len(images)} images with neighbour-restricted matching...")
+    try:
+        # Features at registration resolution, downscaled copies for seam estimation
+        finder = cv2.ORB_create()
+        features = []
+        seam_images = []
+        height, width = images[0].shape[:2]
+        work_scale = min(1.0, np.sqrt(work_megapix * 1e6 / (width * height)))
+        seam_scale = min(1.0, np.sqrt(seam_megapix * 1e6 / (width * height)))
+        seam_work_aspect = seam_scale / work_scale
+        for img in images:
+            img_work = cv2.resize(img, None, fx=work_scale, fy=work_scale, interpolation=cv2.INTER_LINEAR_EXACT)
+            features.append(cv2.detail.computeImageFeatures2(finder, img_work))
+            seam_images.append(cv2.resize(img, None, fx=seam_scale, fy=seam_scale, interpolation=cv2.INTER_LINEAR_EXACT))
+        
+        # Match only the neighbouring pairs
+        matcher = cv2.detail_BestOf2NearestMatcher(False, 0.3)
+        pairwise_matches = matcher.apply2(features, neighbor_match_mask(len(images), neighbors, grid_cols))
+        matcher.collectGarbage()
+        
+        # Keep the largest connected set of confidently matched frames
+        indices = cv2.detail.leaveBiggestComponent(features, pairwise_matches, conf_thresh)
+        indices = [int(i) for i in np.array(indices).ravel()]
+        if len(indices) < len(images):
+            progress(f"Dropped {len(images) - len(indices)} frames without confident neighbour matches")
+        images = [images[i] for i in indices]
+        seam_images = [seam_images[i] for i in indices]
+        # Features and the N x N match table must describe the same frames as the cameras
+        num_images = len(features)
+        features = [features[i] for i in indices]
+        subset_matches = []
+        for src, i in enumerate(indices):
+            for dst, j in enumerate(indices):
+                match = pairwise_matches[i * num_images + j]
+                if match.src_img_idx >= 0:
+                    match.src_img_idx, match.dst_img_idx = src, dst
+                subset_matches.append(match)
+        pairwise_matches = subset_matches
+        if len(images) < 2:
+            progress("Stitching failed: Need more images")
+            return None
+        
+        # Camera estimation and bundle adjustment
+        ok, cameras = cv2.detail_HomographyBasedEstimator().apply(features, pairwise_matches, None)
+        if not ok:
+            progress("Stitching failed: Homography estimation failed")
+            return None
+        for cam in cameras:
+            cam.R = cam.R.astype(np.float32)
+        adjuster = cv2.detail_BundleAdjusterRay()
+        adjuster.setConfThresh(conf_thresh)
+        refine_mask = np.zeros((3, 3), np.uint8)
+        refine_mask[0, 0] = refine_mask[0, 1] = refine_mask[0, 2] = refine_mask[1, 1] = refine_mask[1, 2] = 1
+        adjuster.setRefinementMask(refine_mask)
+        ok, cameras = adjuster.apply(features, pairwise_matches, cameras)
+        if not ok:
+            progress("Stitching failed: Camera parameter adjustment failed")
+            return None
+        
+        warped_image_scale = float(np.median([cam.focal for cam in cameras]))
+        rmats = cv2.detail.waveCorrect([np.copy(cam.R) for cam in cameras], cv2.detail.WAVE_CORRECT_HORIZ)
+        for cam, R in zip(cameras, rmats):
+            cam.R = R
+        
+        # Exposure compensation and seams on low-resolution warped frames
+        warper = cv2.PyRotationWarper('spherical', warped_image_scale * seam_work_aspect)
+        corners, masks_warped, images_warped = [], [], []
+        for img, cam in zip(seam_images, cameras):
+            K = cam.K().astype(np.float32)
+            K[0, 0] *= seam_work_aspect
+            K[0, 2] *= seam_work_aspect
+            K[1, 1] *= seam_work_aspect
+            K[1, 2] *= seam_work_aspect
+            corner, img_warped = warper.warp(img, K, cam.R, cv2.INTER_LINEAR, cv2.BORDER_REFLECT)
+            _, mask_warped = warper.warp(np.full(img.shape[:2], 255, np.uint8), K, cam.R,
+                                         cv2.INTER_NEAREST, cv2.BORDER_CONSTANT)
+            corners.append(corner)
+            images_warped.append(img_warped)
+            masks_warped.append(mask_warped)
+        
+        compensator = cv2.detail.ExposureCompensator_createDefault(cv2.detail.ExposureCompensator_GAIN_BLOCKS)
+        compensator.feed(corners=corners, images=images_warped, masks=masks_warped)
+        seam_finder = cv2.detail_GraphCutSeamFinder('COST_COLOR')
+        masks_warped = seam_finder.find([img.astype(np.float32) for img in images_warped], corners, masks_warped)
+        
+        # Compose at full resolution with a multi-band blender
+        compose_work_aspect = 1.0 / work_scale
+        warper = cv2.PyRotationWarper('spherical', warped_image_scale * compose_work_aspect)
+        corners, sizes = [], []
+        for img, cam in zip(images, cameras):
+            cam.focal *= compose_work_aspect
+            cam.ppx *= compose_work_aspect
+            cam.ppy *= compose_work_aspect
+            roi = warper.warpRoi((img.shape[1], img.shape[0]), cam.K().astype(np.float32), cam.R)
+            corners.append(roi[0:2])
+            sizes.append(roi[2:4])
+        
+        dst_roi = cv2.detail.resultRoi(corners=corners, sizes=sizes)
+        blend_width = np.sqrt(dst_roi[2] * dst_roi[3]) * 5 / 100
+        blender = cv2.detail_MultiBandBlender()
+        blender.setNumBands(max(1, int(np.log(blend_width) / np.log(2.0) - 1.0)))
+        blender.prepare(dst_roi)
+        for idx, (img, cam) in enumerate(zip(images, cameras)):
+            K = cam.K().astype(np.float32)
+            corner, img_warped = warper.warp(img, K, cam.R, cv2.INTER_LINEAR, cv2.BORDER_REFLECT)
+            _, mask_warped = warper.warp(np.full(img.shape[:2], 255, np.uint8), K, cam.R,
+                                         cv2.INTER_NEAREST, cv2.BORDER_CONSTANT)
+            compensator.apply(idx, corners[idx], img_warped, mask_warped)
+            seam_mask = cv2.resize(cv2.dilate(masks_warped[idx], None),
+                                   (mask_warped.shape[1], mask_warped.shape[0]), 0, 0, cv2.INTER_LINEAR_EXACT)
+            mask_warped = cv2.bitwise_and(seam_mask, mask_warped)
+            blender.feed(cv2.UMat(img_warped.astype(np.int16)), mask_warped, corners[idx])
+        pano, _ = blender.blend(None, None)
+    except cv2.error as e:
+        progress(f"Stitching failed: {e}")
+        return None
+    
+    return np.clip(pano, 0, 255).astype(np.uint8)
+
+def list_key_frames(frame_dir):
+    """List key frame paths in capture order (frame2 before frame10)"""
+    frames = [f for f in os.listdir(frame_dir) if f.startswith('frame') and f.endswith('.jpg')]
+    frames.sort(key=lambda f: int(f[len('frame'):-len('.jpg')]))
+    return [os.path.join(frame_dir, f) for f in frames]
+
+def detect_features(images, work_megapix=0.6, nfeatures=1500):
+    """Detect ORB features once per image at registration resolution; returns (points, descriptors) per image"""
+    orb = cv2.ORB_create(nfeatures=nfeatures)
+    features = []
+    for img in images:
+        height, width = img.shape[:2]
+        work_scale = min(1.0, np.sqrt(work_megapix * 1e6 / (width * height)))
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if work_scale < 1.0:
+            gray = cv2.resize(gray, None, fx=work_scale, fy=work_scale, interpolation=cv2.INTER_AREA)
+        kp, des = orb.detectAndCompute(gray, None)
+        pts = np.float32([k.pt for k in kp]).reshape(-1, 2) / work_scale
+        features.append((pts, des))
+    return features
+
+def match_features(features1, features2, match_ratio=0.8):
+    """Ratio-test matches between two detect_features entries; returns matched point arrays"""
+    pts1, des1 = features1
+    pts2, des2 = features2
+    if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
+        return np.empty((0, 2), np.float32), np.empty((0, 2), np.float32)
+    bf = cv2.BFMatcher(normType=cv2.NORM_HAMMING)
+    good = [m[0] for m in bf.knnMatch(des1, des2, k=2)
+            if len(m) == 2 and m[0].distance < match_ratio * m[1].distance]
+    return pts1[[m.queryIdx for m in good]], pts2[[m.trainIdx for m in good]]
+
+def focal_from_homography(H):
+    """Estimate focal length from a rotation-only homography (Shum & Szeliski), or None"""
+    h = (H / H[2, 2]).ravel()
+    
+    # Focal along Y axis
+    f1 = None
+    d1 = h[6] * h[7]
+    d2 = (h[7] - h[6]) * (h[7] + h[6])
+    v1 = -(h[0] * h[1] + h[3] * h[4]) / d1 if d1 != 0 else -1
+    v2 = (h[0] * h[0] + h[3] * h[3] - h[1] * h[1] - h[4] * h[4]) / d2 if d2 != 0 else -1
+    v1, v2 = max(v1, v2), min(v1, v2)
+    if v1 > 0 and v2 > 0:
+        f1 = np.sqrt(v1 if abs(d1) > abs(d2) else v2)
+    elif v1 > 0:
+        f1 = np.sqrt(v1)
+    
+    # Focal along X axis
+    f0 = None
+    d1 = h[0] * h[3] + h[1] * h[4]
+    d2 = h[0] * h[0] + h[1] * h[1] - h[3] * h[3] - h[4] * h[4]
+    v1 = -h[2] * h[5] / d1 if d1 != 0 else -1
+    v2 = (h[5] * h[5] - h[2] * h[2]) / d2 if d2 != 0 else -1
+    v1, v2 = max(v1, v2), min(v1, v2)
+    if v1 > 0 and v2 > 0:
+        f0 = np.sqrt(v1 if abs(d1) > abs(d2) else v2)
+    elif v1 > 0:
+        f0 = np.sqrt(v1)
+    
+    if f0 is None or f1 is None:
+        return None
+    return float(np.sqrt(f0 * f1))
+
+def cylindrical_maps(width, height, focal):
+    """Build remap tables projecting an image of the given size onto a cylinder"""
+    xc, yc = width / 2.0, height / 2.0
+    out_width = int(2 * focal * np.arctan(xc / focal))
+    out_xc = out_width / 2.0
+    
+    u, v = np.meshgrid(np.arange(out_width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    theta = (u - out_xc) / focal
+    map_x = focal * np.tan(theta) + xc
+    map_y = (v - yc) / np.cos(theta) + yc
+    return map_x.astype(np.float32), map_y.astype(np.float32)
+
+def cylindrical_points(pts, width, height, focal):
+    """Project image points onto the cylinder used by cylindrical_maps"""
+    xc, yc = width / 2.0, height / 2.0
+    out_xc = int(2 * focal * np.arctan(xc / focal)) / 2.0
+    x = pts[:, 0] - xc
+    y = pts[:, 1] - yc
+    u = focal * np.arctan2(x, focal) + out_xc
+    v = focal * y / np.sqrt(x * x + focal * focal) + yc
+    return np.stack([u, v], axis=1)
+
+def estimate_translation(src_pts, dst_pts, inlier_thresh=3.0):
+    """Robustly fit a 2D translation; returns (shift, rms residual, inlier count)"""
+    diffs = src_pts - dst_pts
+    shift = np.median(diffs, axis=0)
+    for _ in range(3):
+        residuals = np.linalg.norm(diffs - shift, axis=1)
+        inliers = residuals < inlier_thresh
+        if not np.any(inliers):
+            return shift, float('inf'), 0
+        shift = diffs[inliers].mean(axis=0)
+    residuals = np.linalg.norm(diffs[inliers] - shift, axis=1)
+    return shift, float(np.sqrt(np.mean(residuals ** 2))), int(np.count_nonzero(inliers))
+
+def stitch_images_cylindrical(image_paths, scale=1.0, max_residual=2.5, min_inliers=30, min_inlier_ratio=0.8,
+                              feather=40, work_megapix=0.6, progress=print):
+    """Fast path for pure horizontal pans: cylindrical pre-warp, translation-only alignment
+    of consecutive key frames and a feathered seam. Returns None when the translation
+    model does not fit, so callers can fall back to the general stitcher."""
+    images = []
+    for path in image_paths:
+        img = cv2.imread(path)
+        if img is None:
+            progress(f"Cannot read image: {path}")
+            continue
+        if scale < 1.0:
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        images.append(img)
+    
+    if len(images) < 2:
+        progress("At least two images are required for stitching")
+        return None
+    
+    height, width = images[0].shape[:2]
+    if any(img.shape[:2] != (height, width) for img in images):
+        progress("Cylindrical fast path requires equally sized frames")
+        return None
+    
+    progress(f"Starting cylindrical fast-path stitch of {len(images)} images...")
+    
+    # Detect features once per frame and match consecutive frames only
+    features = detect_features(images, work_megapix)
+    pair_matches = []
+    focals = []
+    center = np.float32([width / 2.0, height / 2.0])
+    for i in range(len(images) - 1):
+        src, dst = match_features(features[i], features[i + 1])
+        if len(src) < min_inliers:
+            progress(f"Not enough matches between frames {i} and {i + 1}")
+            return None
+        
+        # Estimate focal length from the pair's homography
+        H, mask = cv2.findHomography(src - center, dst - center, cv2.RANSAC, 5.0)
+        if H is not None:
+            # The translation model is judged against the matches the homography explains
+            keep = mask.ravel() == 1
+            src, dst = src[keep], dst[keep]
+            focal = focal_from_homography(H)
+            if focal is not None:
+                focals.append(focal)
+        pair_matches.append((src, dst))
+    
+    # Fall back to a ~53 degree horizontal field of view if no pair gave a focal estimate
+    focal = float(np.median(focals)) if focals else float(width)
+    progress(f"Estimated focal length: {focal:.1f}px")
+    
+    # Align consecutive frames on the cylinder with a translation model
+    offsets = [np.zeros(2)]
+    for i, (src, dst) in enumerate(pair_matches):
+        src_c = cylindrical_points(src, width, height, focal)
+        dst_c = cylindrical_points(dst, width, height, focal)
+        shift, rms, inliers = estimate_translation(src_c, dst_c)
+        # Residuals are only measured over the inliers, so rotation or zoom between frames
+        # shows up as a low inlier ratio rather than a high residual
+        if inliers < min_inliers or inliers < min_inlier_ratio * len(src) or rms > max_residual:
+            progress(f"Translation model rejected between frames {i} and {i + 1} "
+                     f"(inliers={inliers}/{len(src)}, residual={rms:.2f}px)")
+            return None
+        offsets.append(offsets[-1] + shift)
+    
+    # Warp frames onto the cylinder (same maps for every frame)
+    map_x, map_y = cylindrical_maps(width, height, focal)
+    mask = cv2.remap(np.full((height, width), 255, np.uint8), map_x, map_y,
+                     cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT) > 0
+    
+    # Place frames on the canvas
+    offsets = np.round(np.array(offsets)).astype(int)
+    offsets -= offsets.min(axis=0)
+    warp_h, warp_w = map_x.shape
+    canvas_w = int(offsets[:, 0].max()) + warp_w
+    canvas_h = int(offsets[:, 1].max()) + warp_h
+    
+    # Seams sit halfway between horizontally adjacent frame centres
+    order = np.argsort(offsets[:, 0], kind='stable')
+    centers = offsets[order, 0] + warp_w / 2.0
+    seams = (centers[:-1] + centers[1:]) / 2.0
+    
+    accum = np.zeros((canvas_h, canvas_w, 3), np.float32)
+    weight_sum = np.zeros((canvas_h, canvas_w), np.float32)
+    xs = np.arange(warp_w, dtype=np.float32)
+    for rank, idx in enumerate(order):
+        x0, y0 = offsets[idx]
+        x = xs + x0
+        # Linear ramp of width `feather` across each seam
+        ramp = np.ones(warp_w, np.float32)
+        if rank > 0:
+            ramp *= np.clip((x - seams[rank - 1]) / feather + 0.5, 0, 1)
+        if rank < len(order) - 1:
+            ramp *= np.clip((seams[rank] - x) / feather + 0.5, 0, 1)
+        weight = mask * ramp[np.newaxis, :]
+        
+        warped = cv2.remap(images[idx], map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+        accum[y0:y0 + warp_h, x0:x0 + warp_w] += warped * weight[..., np.newaxis]
+        weight_sum[y0:y0 + warp_h, x0:x0 + warp_w] += weight
+    
+    pano = accum / np.maximum(weight_sum, 1e-6)[..., np.newaxis]
+    return np.clip(pano, 0, 255).astype(np.uint8)
+
+def optimize_key_frames(frame_paths, min_overlap=0.4, min_inliers=20, max_span=5, work_megapix=0.6,
+                        progress=print):
+    """Drop redundant key frames: build an overlap graph between frames up to max_span apart
+    and keep the fewest frames whose consecutive pairs still overlap by min_overlap"""
+    images = [cv2.imread(path) for path in frame_paths]
+    if len(images) < 3 or any(img is None for img in images):
+        return list(frame_paths)
+    
+    # Features are detected once per frame and reused for every pair; a smaller
+    # feature budget is enough to measure overlap and keeps the pairwise matching cheap
+    features = detect_features(images, work_megapix, nfeatures=500)
+    
+    # Overlap graph: fraction of frame i covered by frame j, for j up to max_span ahead
+    overlap = {}
+    for i in range(len(images)):
+        height, width = images[i].shape[:2]
+        corners = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+        failures = 0
+        for j in range(i + 1, min(i + max_span, len(images) - 1) + 1):
+            src, dst = match_features(features[i], features[j])
+            H, mask = None, None
+            if len(src) >= min_inliers:
+                H, mask = cv2.findHomography(dst, src, cv2.RANSAC, 5.0)
+            if H is None or np.count_nonzero(mask) < min_inliers:
+                # One failure may just be a blurry frame that can be skipped; overlap only
+                # shrinks further along the sequence, so stop after two in a row
+                failures += 1
+                if failures == 2:
+                    break
+                continue
+            failures = 0
+            h2, w2 = images[j].shape[:2]
+            proj = cv2.perspectiveTransform(
+                np.float32([[0, 0], [w2, 0], [w2, h2], [0, h2]]).reshape(-1, 1, 2), H).reshape(-1, 2)
+            area, _ = cv2.intersectConvexConvex(corners, proj)
+            overlap[i, j] = area / (width * height)
+    
+    # Path from first to last frame with the fewest links below min_overlap, then the fewest
+    # frames, then the larger weakest overlap. Neighbouring frames are always connected (as
+    # a below-threshold link if need be) so the original sequence stays reachable.
+    best = [(0, 0, 0.0, None)] + [None] * (len(images) - 1)
+    for j in range(1, len(images)):
+        for i in range(max(0, j - max_span), j):
+            ov = overlap.get((i, j), 0.0)
+            if best[i] is None or (ov < min_overlap and i != j - 1):
+                continue
+            weak_links = best[i][0] + (ov < min_overlap)
+            weakest = ov if i == 0 else min(ov, -best[i][2])
+            candidate = (weak_links, best[i][1] + 1, -weakest, i)
+            if best[j] is None or candidate[:3] < best[j][:3]:
+                best[j] = candidate
+    
+    kept = []
+    j = len(images) - 1
+    while j is not None:
+        kept.append(j)
+        j = best[j][3]
+    kept.reverse()
+    
+    removed = len(images) - len(kept)
+    progress(f"Key frame optimization kept {len(kept)} of {len(images)} frames (removed {removed}): {kept}")
+    return [frame_paths[i] for i in kept]
+
+def stitch_images(image_paths, engine='stitcher', scale=1.0, neighbors=2, grid_cols=None, progress=print):
+    """Stitch with the chosen engine; 'auto' tries the cylindrical fast path first
+    and falls back to cv2.Stitcher when the translation model does not fit"""
+    if engine == 'neighbors':
+        return stitch_images_neighbors(image_paths, scale=scale, neighbors=neighbors, grid_cols=grid_cols,
+                                       progress=progress)
+    if engine in ('auto', 'cylindrical'):
+        pano = stitch_images_cylindrical(image_paths, scale=scale, progress=progress)
+        if pano is not None or engine == 'cylindrical':
+            return pano
+        progress("Falling back to general stitcher")
+    return stitch_images_all_at_once(image_paths, scale=scale, progress=progress)
+
 def crop_content(image):
     """Crop black borders from image, keeping only the valid content area"""
     if image is None:
@@ -251,69 +865,153 @@ def show_orb(img1_path, img2_path, output_path='orb_matches.jpg'):
     
     return len(matches)
 
-def main():
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(description='Generate panoramic image from video file')
-    parser.add_argument('video', help='Input video file path')
-    parser.add_argument('--output', default='panorama.jpg', help='Output panorama filename')
-    #parser.add_argument('--temp_dir', default='key_frames', help='Directory for storing temporary key frames')
-    #parser.add_argument('--keep_frames', action='store_true', help='Keep captured key frames instead of deleting them')
-    #parser.add_argument('--test_orb', action='store_true', help='Test ORB feature matching (requires two key frames)')
-    args = parser.parse_args()
+def generate_panorama(video_path, output_path, temp_dir='key_frames', engine='stitcher',
+                      keep_frames=False, progress=print, sift=None, optimize=False, selector='sift',
+                      neighbors=2, grid_cols=None, budget=None, cancel_event=None):
+    """Run the full pipeline from video to saved panorama; returns the panorama or None.
+    Setting cancel_event stops capture early and skips the remaining steps, so nothing is written."""
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
     
     start_time = time.time()
+    if budget is None:
+        budget = ThreadBudget()
     
     # Step 1: Capture key frames
-    print(f"Capturing key frames from video {args.video}...")
-    frame_count = capture_key_frames(args.video, args.temp_dir)
+    progress(f"Capturing key frames from video {video_path}...")
+    if selector == 'klt':
+        frame_count = capture_key_frames_klt(video_path, temp_dir, sift=sift, budget=budget, progress=progress,
+                                             cancel_event=cancel_event)
+    else:
+        frame_count = capture_key_frames(video_path, temp_dir, sift=sift, budget=budget, progress=progress,
+                                         cancel_event=cancel_event)
     
+    if cancelled():
+        progress("Cancelled before stitching")
+        return None
     if frame_count <= 1:
-        print("Not enough key frames captured for stitching")
-        return
-    
-    # Test ORB feature matching
-    #if args.test_orb:
-    #    frames = sorted([os.path.join(args.temp_dir, f) for f in os.listdir(args.temp_dir) 
-    #                if f.startswith('frame') and f.endswith('.jpg')])
-    #    if len(frames) >= 2:
-    #        print("\nTesting ORB feature matching...")
-    #        show_orb(frames[0], frames[1], 'orb_matches.jpg')
-    #    else:
-    #        print("Not enough key frames for ORB testing")
+        progress("Not enough key frames captured for stitching")
+        return None
     
     #  Stitch key frames
-    print("\nStarting to stitch key frames...")
-    frames = sorted([os.path.join(args.temp_dir, f) for f in os.listdir(args.temp_dir) 
-                    if f.startswith('frame') and f.endswith('.jpg')])
+    progress("\nStarting to stitch key frames...")
+    frames = list_key_frames(temp_dir)
     
     if not frames:
-        print(f"No key frames found in {args.temp_dir}")
-        return
+        progress(f"No key frames found in {temp_dir}")
+        return None
     
-    print(f"Found {len(frames)} key frames, starting stitching")
-    pano = stitch_images_all_at_once(frames)
+    # Drop redundant, heavily overlapping key frames before stitching
+    removed = 0
+    if optimize:
+        opt_start = time.time()
+        with budget.stage('stitching'):
+            kept = optimize_key_frames(frames, progress=progress)
+        removed = len(frames) - len(kept)
+        frames = kept
+        progress(f"Removed {removed} redundant key frames in {time.time() - opt_start:.1f} seconds")
+    
+    if cancelled():
+        progress("Cancelled before stitching")
+        return None
+    progress(f"Found {len(frames)} key frames, starting stitching")
+    stitch_start = time.time()
+    with budget.stage('stitching'):
+        pano = stitch_images(frames, engine, neighbors=neighbors, grid_cols=grid_cols, progress=progress)
+    stitch_time = time.time() - stitch_start
+    if removed:
+        # Stitch cost grows at least linearly with the frame count
+        progress(f"Stitching took {stitch_time:.1f} seconds; the {removed} removed frames "
+                 f"saved an estimated {stitch_time / len(frames) * removed:.1f} seconds or more")
+    
+    # A stitch already running cannot be interrupted, but its result is not saved
+    if cancelled():
+        progress("Cancelled, panorama not saved")
+        pano = None
     
     # Save result
     if pano is not None:
         # Crop black edges
-        print("Cropping black edges...")
+        progress("Cropping black edges...")
         pano = crop_content(pano)
         
         # Save result
-        cv2.imwrite(args.output, pano)
-        print(f"Panorama image saved as {args.output}")
-    else:
-        print("Stitching failed")
+        with budget.stage('encoding'):
+            cv2.imwrite(output_path, pano)
+        progress(f"Panorama image saved as {output_path}")
+    elif not cancelled():
+        progress("Stitching failed")
     
     # Clean up temporary files
-    if not args.keep_frames:
-        print(f"Cleaning up temporary directory {args.temp_dir}...")
-        shutil.rmtree(args.temp_dir)
+    if not keep_frames:
+        progress(f"Cleaning up temporary directory {temp_dir}...")
+        shutil.rmtree(temp_dir)
     else:
-        print(f"Keeping key frames in {args.temp_dir} directory")
+        progress(f"Keeping key frames in {temp_dir} directory")
+    
+    for line in budget.report():
+        progress(line)
     
     elapsed_time = time.time() - start_time
-    print(f"Processing complete, took {elapsed_time:.1f} seconds")
+    progress(f"Processing complete, took {elapsed_time:.1f} seconds")
+    return pano
+
+def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Generate panoramic image from video file')
+    parser.add_argument('video', help='Input video file path')
+    parser.add_argument('--output', default='panorama.jpg', help='Output panorama filename')
+    parser.add_argument('--temp_dir', default='key_frames', help='Directory for storing temporary key frames')
+    parser.add_argument('--keep_frames', action='store_true', help='Keep captured key frames instead of deleting them')
+    parser.add_argument('--engine', choices=ENGINES, default='stitcher',
+                        help='Stitching engine: general cv2.Stitcher, cylindrical fast path for horizontal pans, '
+                             'auto (fast path with fallback), or neighbors (matches only neighbouring key frames)')
+    parser.add_argument('--neighbors', type=int, default=2,
+                        help='Temporal neighbours each key frame is matched with (neighbors engine)')
+    parser.add_argument('--grid_cols', type=int, default=None,
+                        help='Columns of a serpentine 2D scan; frames are matched with their grid neighbours '
+                             '(neighbors engine)')
+    parser.add_argument('--selector', choices=SELECTORS, default='sift',
+                        help='Key frame selection: SIFT matching on sampled frames, or KLT tracking '
+                             'with SIFT only as a re-acquisition fallback')
+    parser.add_argument('--optimize_frames', action='store_true',
+                        help='Remove redundant key frames that are not needed to keep consecutive frames overlapping')
+    parser.add_argument('--threads', type=positive_int, default=None,
+                        help='Total thread budget shared by decode, feature extraction, stitching and encoding '
+                             '(default: CPUs available to this process, respecting cgroup limits; '
+                             'with --worker the worker\'s own budget applies)')
+    parser.add_argument('--worker', nargs='?', const='', default=None, metavar='ADDRESS',
+                        help='Submit the job to a running panorama_worker (socket path or host:port, '
+                             'default address if omitted)')
+    parser.add_argument('--priority', type=int, default=0, help='Job priority when using --worker (higher runs first)')
+    #parser.add_argument('--test_orb', action='store_true', help='Test ORB feature matching (requires two key frames)')
+    args = parser.parse_args()
+    
+    # Hand the job to the warm worker process instead of running it here
+    if args.worker is not None:
+        from panorama_worker import DEFAULT_ADDRESS, submit_job, wait_for_job
+        address = args.worker or DEFAULT_ADDRESS
+        job_id = submit_job(address, os.path.abspath(args.video), os.path.abspath(args.output),
+                            engine=args.engine, priority=args.priority, optimize=args.optimize_frames,
+                            selector=args.selector, neighbors=args.neighbors, grid_cols=args.grid_cols)
+        print(f"Submitted job {job_id} to worker at {address}")
+        job = wait_for_job(address, job_id, on_progress=print)
+        if job['state'] != 'done':
+            print(f"Worker job {job['state']}: {job.get('error') or 'no panorama produced'}")
+        return
+    
+    generate_panorama(args.video, args.output, args.temp_dir, args.engine, args.keep_frames,
+                      optimize=args.optimize_frames, selector=args.selector,
+                      neighbors=args.neighbors, grid_cols=args.grid_cols, budget=ThreadBudget(args.threads))
+    
+    # Test ORB feature matching (needs --keep_frames)
+    #if args.test_orb:
+    #    frames = list_key_frames(args.temp_dir)
+    #    if len(frames) >= 2:
+    #        print("\nTesting ORB feature matching...")
+    #        show_orb(frames[0], frames[1], 'orb_matches.jpg')
+    #    else:
+    #        print("Not enough key frames for ORB testing")
 
 
 if __name__ == "__main__":
@@ -1,15 +1,36 @@
 import tkinter as tk
 from tkinter import filedialog, ttk, messagebox
 import os
+import multiprocessing
 import threading
+import shutil
 import sys
+import tempfile
 import time
 import cv2
+import numpy as np
 from pathlib import Path
 from PIL import Image, ImageTk
 
 # Import main program functionality
-from main import capture_key_frames, stitch_images_all_at_once, crop_content
+from main import (ENGINES, SELECTORS, capture_key_frames, capture_key_frames_klt, list_key_frames,
+                  optimize_key_frames, stitch_images, crop_content)
+from panorama_worker import DEFAULT_ADDRESS, submit_job, wait_for_job
+from thread_budget import ThreadBudget, available_cpus
+
+# Downscale factor for the fast first-pass preview stitch
+PREVIEW_SCALE = 0.25
+
+def render_full_resolution(frames, engine, result_path, threads, conn):
+    """Full-resolution stitch in a child process, so Cancel can terminate it.
+    Progress messages and the outcome go back through conn; the panorama is saved to result_path."""
+    cv2.setNumThreads(threads)
+    cpu_start = time.process_time()
+    pano = stitch_images(frames, engine, progress=lambda message: conn.send(("progress", message)))
+    if pano is not None:
+        np.save(result_path, pano)
+    conn.send(("done", pano is not None, time.process_time() - cpu_start))
+    conn.close()
 
 class PanoramaApp:
     def __init__(self, root):
@@ -22,7 +43,14 @@ class PanoramaApp:
         self.video_path = tk.StringVar()
         self.output_path = tk.StringVar(value="panorama.jpg")
         self.temp_dir = tk.StringVar(value="key_frames")
+        self.fast_preview = tk.BooleanVar(value=True)
+        self.engine = tk.StringVar(value="stitcher")
+        self.selector = tk.StringVar(value="sift")
+        self.use_worker = tk.BooleanVar(value=False)
+        self.optimize_frames = tk.BooleanVar(value=False)
+        self.threads = tk.IntVar(value=available_cpus())
         self.is_processing = False
+        self.cancel_event = threading.Event()
         
         # Image related variables
         self.crop_mode = False
@@ -74,6 +102,43 @@ class PanoramaApp:
         # Configure grid column weights
         input_frame.columnconfigure(1, weight=1)
         
+        # Stitching engine selection
+        engine_frame = ttk.Frame(control_frame)
+        engine_frame.pack(fill=tk.X, pady=(5, 0))
+        ttk.Label(engine_frame, text="Engine:").pack(side=tk.LEFT)
+        self.engine_combo = ttk.Combobox(engine_frame, textvariable=self.engine, state="readonly", width=12,
+                                         values=ENGINES)
+        self.engine_combo.pack(side=tk.LEFT, padx=5)
+        
+        # Key frame selection method
+        selector_frame = ttk.Frame(control_frame)
+        selector_frame.pack(fill=tk.X, pady=(5, 0))
+        ttk.Label(selector_frame, text="Selector:").pack(side=tk.LEFT)
+        self.selector_combo = ttk.Combobox(selector_frame, textvariable=self.selector, state="readonly", width=12,
+                                           values=SELECTORS)
+        self.selector_combo.pack(side=tk.LEFT, padx=5)
+        
+        # Total thread budget for processing (one thread is kept free for the interface)
+        threads_frame = ttk.Frame(control_frame)
+        threads_frame.pack(fill=tk.X, pady=(5, 0))
+        ttk.Label(threads_frame, text="Threads:").pack(side=tk.LEFT)
+        self.threads_spin = ttk.Spinbox(threads_frame, from_=1, to=max(64, available_cpus()),
+                                        textvariable=self.threads, width=5)
+        self.threads_spin.pack(side=tk.LEFT, padx=5)
+        
+        # Two-pass mode: show a low-resolution preview before the full-resolution render
+        self.preview_check = ttk.Checkbutton(control_frame, text="Fast preview (two-pass)", variable=self.fast_preview)
+        self.preview_check.pack(anchor=tk.W, pady=(5, 0))
+        
+        # Drop redundant key frames before stitching
+        self.optimize_check = ttk.Checkbutton(control_frame, text="Remove redundant frames", variable=self.optimize_frames)
+        self.optimize_check.pack(anchor=tk.W)
+        
+        # Submit jobs to a running panorama_worker instead of processing in this process
+        self.worker_check = ttk.Checkbutton(control_frame, text="Use background worker", variable=self.use_worker,
+                                            command=self.update_worker_options)
+        self.worker_check.pack(anchor=tk.W)
+        
         # Action buttons area
         action_frame = ttk.Frame(control_frame)
         action_frame.pack(fill=tk.X, pady=15)
@@ -166,6 +231,11 @@ class PanoramaApp:
         self.video_entry.config(state=state)
         self.output_entry.config(state=state)
         self.generate_btn.config(state=state)
+        self.worker_check.config(state=state)
+        self.optimize_check.config(state=state)
+        self.update_worker_options()
+        self.engine_combo.config(state=tk.DISABLED if is_processing else "readonly")
+        self.selector_combo.config(state=tk.DISABLED if is_processing else "readonly")
         self.cancel_btn.config(state=cancel_state)
         
         if is_processing:
@@ -173,14 +243,27 @@ class PanoramaApp:
         else:
             self.progress.stop()
     
+    def update_worker_options(self):
+        """Grey out options the background worker does not honour"""
+        local_only = tk.DISABLED if self.is_processing or self.use_worker.get() else tk.NORMAL
+        self.preview_check.config(state=local_only)
+        self.threads_spin.config(state=local_only)
+    
     def cancel_process(self):
+        # The processing thread stops at its next check and discards its result,
+        # so the window is released straight away
         if self.is_processing:
-            self.add_status("Cancelling process...")
+            self.cancel_event.set()
+            self.add_status("Process cancelled")
+            self.process_complete(False, "Cancelled by user")
+    
+    def finish(self, cancel_event, *args, **kwargs):
+        """Hand a result to the main thread unless the run was cancelled (Cancel already reset the UI)"""
+        self.root.after(0, lambda: cancel_event.is_set() or self.process_complete(*args, **kwargs))
     
     def generate_panorama(self):
         video_path = self.video_path.get()
         output_path = self.output_path.get()
-        temp_dir = self.temp_dir.get()
         
         # Check video file
         if not video_path or not os.path.exists(video_path):
@@ -207,45 +290,107 @@ class PanoramaApp:
                 messagebox.showerror("Error", f"Cannot create output directory: {str(e)}")
                 return
         
-        # Update UI status
+        # Check thread count (only used when processing locally)
+        threads = None
+        if not self.use_worker.get():
+            try:
+                threads = self.threads.get()
+            except tk.TclError:
+                threads = 0
+            if threads < 1:
+                messagebox.showerror("Error", "Please enter a whole number of threads (at least 1)")
+                return
+        
+        # Update UI status; every run gets its own cancel flag so a cancelled run
+        # that is still winding down cannot pick up the next run's state
+        self.cancel_event = threading.Event()
         self.update_ui_for_processing(True)
         
         # Run processing in a separate thread
-        threading.Thread(
-            target=self.process_panorama,
-            args=(video_path, output_path, temp_dir),
-            daemon=True
-        ).start()
+        if self.use_worker.get():
+            target = self.process_with_worker
+            args = (video_path, output_path, self.engine.get(), self.optimize_frames.get(), self.selector.get(),
+                    self.cancel_event)
+        else:
+            # Key frames go to a fresh directory per run for the same reason
+            temp_dir = tempfile.mkdtemp(prefix=f"{self.temp_dir.get()}_", dir=".")
+            target = self.process_panorama
+            args = (video_path, output_path, temp_dir, self.fast_preview.get(), self.engine.get(),
+                    self.optimize_frames.get(), self.selector.get(), threads, self.cancel_event)
+        threading.Thread(target=target, args=args, daemon=True).start()
     
-    def process_panorama(self, video_path, output_path, temp_dir):
+    def process_panorama(self, video_path, output_path, temp_dir, fast_preview=True, engine="stitcher",
+                         optimize=False, selector="sift", threads=None, cancel_event=None):
+        cancel_event = cancel_event or threading.Event()
         try:
             self.add_status(f"Processing video...")
             start_time = time.time()
+            budget = ThreadBudget(threads, reserve=1)
             
             # Step 1: Capture key frames
             self.add_status("Step 1/3: Capturing key frames...")
-            frame_count = capture_key_frames(video_path, temp_dir)
+            if selector == "klt":
+                frame_count = capture_key_frames_klt(video_path, temp_dir, budget=budget, cancel_event=cancel_event)
+            else:
+                frame_count = capture_key_frames(video_path, temp_dir, budget=budget, cancel_event=cancel_event)
+            if cancel_event.is_set():
+                return
             
             if frame_count <= 1:
                 self.add_status("Not enough key frames captured")
-                self.root.after(0, lambda: self.process_complete(False, "Not enough key frames"))
+                self.finish(cancel_event, False, "Not enough key frames")
                 return
             
             # Step 2: Stitch key frames
-            self.add_status(f"Step 2/3: Stitching {frame_count} frames...")
-            frames = sorted([os.path.join(temp_dir, f) for f in os.listdir(temp_dir) 
-                           if f.startswith('frame') and f.endswith('.jpg')])
+            frames = list_key_frames(temp_dir)
             
             if not frames:
                 self.add_status(f"No key frames found")
-                self.root.after(0, lambda: self.process_complete(False, "No key frames found"))
+                self.finish(cancel_event, False, "No key frames found")
                 return
             
-            pano = stitch_images_all_at_once(frames)
+            # Drop redundant key frames before either pass
+            removed = 0
+            if optimize:
+                with budget.stage("stitching"):
+                    kept = optimize_key_frames(frames)
+                removed = len(frames) - len(kept)
+                self.add_status(f"Removed {removed} redundant key frames")
+                frames = kept
+                frame_count = len(frames)
+            
+            # First pass: stitch downscaled key frames and show the preview immediately
+            if fast_preview and not cancel_event.is_set():
+                self.add_status(f"Step 2/3: Stitching preview of {frame_count} frames...")
+                with budget.stage("stitching"):
+                    preview = stitch_images(frames, engine, scale=PREVIEW_SCALE)
+                if preview is not None:
+                    preview = crop_content(preview)
+                    self.root.after(0, lambda: cancel_event.is_set() or self.display_array(preview, preview=True))
+                    self.add_status(f"Preview ready after {time.time() - start_time:.1f} seconds, "
+                                    "rendering full resolution (Cancel to reject)...")
+                else:
+                    self.add_status("Preview stitching failed, rendering full resolution...")
+            else:
+                self.add_status(f"Step 2/3: Stitching {frame_count} frames...")
+            
+            # Second pass: full-resolution render in a child process that Cancel terminates
+            if cancel_event.is_set():
+                return
+            stitch_start = time.time()
+            with budget.stage("stitching"):
+                pano = self.run_full_resolution(frames, engine, temp_dir, budget, cancel_event)
+            if cancel_event.is_set():
+                return
+            stitch_time = time.time() - stitch_start
+            if removed:
+                # Stitch cost grows at least linearly with the frame count
+                self.add_status(f"Stitching took {stitch_time:.1f} seconds; the {removed} removed frames "
+                                f"saved an estimated {stitch_time / len(frames) * removed:.1f} seconds or more")
             
             if pano is None:
                 self.add_status("Stitching failed")
-                self.root.after(0, lambda: self.process_complete(False, "Stitching failed"))
+                self.finish(cancel_event, False, "Stitching failed")
                 return
             
             # Step 3: Crop black borders and save result
@@ -253,37 +398,122 @@ class PanoramaApp:
             pano = crop_content(pano)
             
             # Save result
-            cv2.imwrite(output_path, pano)
+            with budget.stage("encoding"):
+                cv2.imwrite(output_path, pano)
             self.add_status(f"Panorama saved successfully")
             
-            # Clean up temporary files
-            self.add_status(f"Cleaning up...")
-            import shutil
-            shutil.rmtree(temp_dir)
+            for line in budget.report():
+                self.add_status(line.strip())
             
             elapsed_time = time.time() - start_time
             self.add_status(f"Complete! Took {elapsed_time:.1f} seconds")
             
             # Update UI in main thread
-            self.root.after(0, lambda: self.process_complete(True))
-            
+            self.finish(cancel_event, True, pano=pano)
+        
         except Exception as e:
             error_msg = str(e)
             self.add_status(f"Error: {error_msg}")
-            self.root.after(0, lambda: self.process_complete(False, error_msg))
+            self.finish(cancel_event, False, error_msg)
+        finally:
+            # Clean up temporary files
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    
+    def run_full_resolution(self, frames, engine, temp_dir, budget, cancel_event):
+        """Stitch at full resolution in a child process; returns the panorama, or None
+        when stitching failed or Cancel terminated the process"""
+        result_path = os.path.join(temp_dir, "full_resolution.npy")
+        # Spawn rather than fork: forking a process that already runs OpenCV and Tk threads is unsafe
+        context = multiprocessing.get_context("spawn")
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=render_full_resolution, daemon=True,
+                                  args=(frames, engine, result_path, budget.allocation["stitching"], sender))
+        process.start()
+        sender.close()
+        
+        success = False
+        try:
+            while not cancel_event.is_set():
+                if not receiver.poll(0.1):
+                    continue
+                message = receiver.recv()
+                if message[0] == "progress":
+                    self.add_status(message[1].strip())
+                    continue
+                _, success, cpu = message
+                budget.add_cpu("stitching", cpu)
+                break
+        except EOFError:
+            # The child exited without reporting a result
+            self.add_status(f"Stitching process exited with code {process.exitcode}")
+        finally:
+            if process.is_alive() and cancel_event.is_set():
+                process.terminate()
+            process.join()
+            receiver.close()
+        
+        if not success or cancel_event.is_set():
+            return None
+        return np.load(result_path)
     
-    def process_complete(self, success, error_msg=None):
+    def process_with_worker(self, video_path, output_path, engine="stitcher", optimize=False, selector="sift",
+                            cancel_event=None):
+        cancel_event = cancel_event or threading.Event()
+        try:
+            start_time = time.time()
+            job_id = submit_job(DEFAULT_ADDRESS, os.path.abspath(video_path), os.path.abspath(output_path),
+                                engine=engine, optimize=optimize, selector=selector)
+            self.add_status(f"Submitted job {job_id} to worker")
+            job = wait_for_job(DEFAULT_ADDRESS, job_id, on_progress=self.add_status,
+                               cancel_event=cancel_event)
+            
+            if cancel_event.is_set():
+                if job['state'] == 'cancelling':
+                    self.add_status(f"Worker job {job_id} stops at its next step and will not save its panorama")
+                elif job['state'] == 'done':
+                    self.add_status(f"Worker job {job_id} had already finished and saved {output_path}")
+                return
+            
+            if job['state'] != 'done':
+                error_msg = job.get('error') or "Worker job failed"
+                self.finish(cancel_event, False, error_msg)
+                return
+            
+            self.add_status(f"Complete! Took {time.time() - start_time:.1f} seconds")
+            # The worker saved the panorama in its own process, so load it from disk
+            self.finish(cancel_event, True, image_path=output_path)
+            
+        except Exception as e:
+            error_msg = f"Worker unavailable: {e}"
+            self.add_status(f"Error: {error_msg}")
+            self.finish(cancel_event, False, error_msg)
+    
+    def process_complete(self, success, error_msg=None, pano=None, image_path=None):
         self.update_ui_for_processing(False)
         
         if success:
+            # Display the stitched result from memory rather than re-reading it from disk
+            if pano is not None:
+                self.display_array(pano)
+            elif image_path is not None and os.path.exists(image_path):
+                self.display_image(image_path)
             messagebox.showinfo("Success", "Panoramic image generated successfully")
-            # Display generated image
-            output_path = self.output_path.get()
-            if os.path.exists(output_path):
-                self.display_image(output_path)
         else:
             messagebox.showerror("Error", f"Processing failed: {error_msg}")
     
+    def display_array(self, image, preview=False):
+        """Display a BGR image array; previews are shown without enabling editing"""
+        img = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        self.original_image = img.copy()
+        self.current_image = img.copy()
+        self.display_current_image()
+        
+        state = tk.DISABLED if preview else tk.NORMAL
+        self.crop_btn.config(state=state)
+        self.save_btn.config(state=state)
+        if preview:
+            self.add_status(f"Showing preview ({img.size[0]}x{img.size[1]})")
+    
     def display_image(self, image_path):
         try:
             # Open image with PIL
@@ -0,0 +1,337 @@
+import argparse
+import itertools
+import json
+import math
+import os
+import queue
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+
+from thread_budget import ThreadBudget, available_cpus, positive_int
+
+# Local address used when none is given: a Unix socket where supported, otherwise loopback TCP
+if hasattr(socket, 'AF_UNIX'):
+    DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), 'panorama_worker.sock')
+else:
+    DEFAULT_ADDRESS = '127.0.0.1:8765'
+
+# Finished jobs (and their progress logs) are kept for status queries up to this many or this long
+KEEP_FINISHED_JOBS = 200
+FINISHED_JOB_TTL = 3600  # Seconds
+
+
+def parse_address(address):
+    """Turn 'host:port' into a TCP address tuple; anything else is a Unix socket path"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or '127.0.0.1', int(port))
+    return address
+
+
+def send_request(address, request):
+    """Send one JSON request to the worker and return its JSON reply"""
+    addr = parse_address(address)
+    family = socket.AF_INET if isinstance(addr, tuple) else socket.AF_UNIX
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(addr)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        reply = sock.makefile('rb').readline()
+    if not reply:
+        raise ConnectionError(f"No reply from worker at {address}")
+    reply = json.loads(reply)
+    if not reply.get('ok'):
+        raise RuntimeError(reply.get('error', 'Worker request failed'))
+    return reply
+
+
+def submit_job(address, video_path, output_path, engine='stitcher', priority=0, optimize=False, selector='sift',
+               neighbors=2, grid_cols=None):
+    """Queue a panorama job on the worker and return its job id"""
+    reply = send_request(address, {
+        'cmd': 'submit',
+        'video': video_path,
+        'output': output_path,
+        'engine': engine,
+        'priority': priority,
+        'optimize': optimize,
+        'selector': selector,
+        'neighbors': neighbors,
+        'grid_cols': grid_cols,
+    })
+    return reply['job_id']
+
+
+def wait_for_job(address, job_id, on_progress=None, poll_interval=0.5, cancel_event=None):
+    """Poll a job until it finishes, passing new progress messages to on_progress.
+    Setting cancel_event asks the worker to drop the job and stops waiting; the returned
+    state is 'cancelling' while a running job winds down."""
+    seen = 0
+    while True:
+        if cancel_event is not None and cancel_event.is_set():
+            send_request(address, {'cmd': 'cancel', 'job_id': job_id})
+            return send_request(address, {'cmd': 'status', 'job_id': job_id, 'since': seen})['job']
+        job = send_request(address, {'cmd': 'status', 'job_id': job_id, 'since': seen})['job']
+        for message in job['progress']:
+            if on_progress is not None:
+                on_progress(message)
+        seen = job['progress_count']
+        if job['state'] in ('done', 'failed', 'cancelled'):
+            return job
+        time.sleep(poll_interval)
+
+
+class PanoramaWorker:
+    """Runs panorama jobs from a priority queue on a pool of warm threads"""
+
+    def __init__(self, num_workers=1, threads=None):
+        self.num_workers = num_workers
+        self.threads_budget = threads or available_cpus()
+        self.jobs = {}
+        # Per-job flags checked by the pipeline between steps; kept out of the JSON-visible job dicts
+        self.cancel_events = {}
+        self.job_queue = queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.start_time = time.time()
+        self.start_cpu = time.process_time()
+        # Counted separately because finished jobs are evicted
+        self.finished_total = 0
+        self.local = threading.local()
+        self.threads = []
+
+    def start(self):
+        # Import the pipeline (and cv2) once, up front, so jobs never pay for it
+        import main
+        self.pipeline = main
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self.run, name=f"panorama-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, video_path, output_path, engine='stitcher', priority=0, optimize=False, selector='sift',
+               neighbors=2, grid_cols=None):
+        if not os.path.exists(video_path):
+            raise FileNotFoundError(f"Video file not found: {video_path}")
+        if engine not in self.pipeline.ENGINES:
+            raise ValueError(f"Unknown engine: {engine} (choose from {', '.join(self.pipeline.ENGINES)})")
+        if selector not in self.pipeline.SELECTORS:
+            raise ValueError(f"Unknown selector: {selector} (choose from {', '.join(self.pipeline.SELECTORS)})")
+        if not isinstance(neighbors, int) or neighbors < 1:
+            raise ValueError(f"neighbors must be a positive integer, got {neighbors!r}")
+        if grid_cols is not None and (not isinstance(grid_cols, int) or grid_cols < 1):
+            raise ValueError(f"grid_cols must be a positive integer, got {grid_cols!r}")
+        seq = next(self.counter)
+        job_id = str(seq + 1)
+        job = {
+            'job_id': job_id,
+            'video': video_path,
+            'output': output_path,
+            'engine': engine,
+            'priority': priority,
+            'optimize': optimize,
+            'selector': selector,
+            'neighbors': neighbors,
+            'grid_cols': grid_cols,
+            'state': 'queued',
+            'progress': [],
+            'error': None,
+            'submitted_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            self.cancel_events[job_id] = threading.Event()
+        # Higher priority first, then submission order
+        self.job_queue.put((-priority, seq, job_id))
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancel a queued job at once; a running job becomes 'cancelling' and stops at the
+        pipeline's next step without writing its output"""
+        with self.lock:
+            job = self.jobs[job_id]
+            if job['state'] == 'queued':
+                job['state'] = 'cancelled'
+                job['finished_at'] = time.time()
+                self.evict_finished()
+            elif job['state'] == 'running':
+                job['state'] = 'cancelling'
+                self.cancel_events[job_id].set()
+            return job['state']
+
+    def evict_finished(self):
+        """Forget the oldest finished jobs beyond KEEP_FINISHED_JOBS or FINISHED_JOB_TTL; call with the lock held"""
+        finished = sorted((j['finished_at'], j['job_id']) for j in self.jobs.values()
+                          if j['state'] in ('done', 'failed', 'cancelled'))
+        expired = time.time() - FINISHED_JOB_TTL
+        for i, (finished_at, job_id) in enumerate(finished):
+            if finished_at < expired or i < len(finished) - KEEP_FINISHED_JOBS:
+                del self.jobs[job_id]
+                self.cancel_events.pop(job_id, None)
+
+    def status(self, job_id, since=0):
+        with self.lock:
+            job = dict(self.jobs[job_id])
+            job['progress_count'] = len(job['progress'])
+            job['progress'] = job['progress'][since:]
+        return job
+
+    def metrics(self):
+        """Throughput since the worker started; latencies and job states cover the jobs still retained"""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        uptime = time.time() - self.start_time
+        cpu_time = time.process_time() - self.start_cpu
+        finished = [j for j in jobs if j['state'] in ('done', 'failed')]
+        latencies = sorted(j['started_at'] - j['submitted_at'] for j in jobs if j['started_at'] is not None)
+        run_times = [j['finished_at'] - j['started_at'] for j in finished]
+        states = {}
+        for job in jobs:
+            states[job['state']] = states.get(job['state'], 0) + 1
+        return {
+            'uptime_s': uptime,
+            'workers': self.num_workers,
+            'thread_budget': self.threads_budget,
+            'cpu_utilization': cpu_time / (uptime * self.threads_budget) if uptime > 0 else 0.0,
+            'jobs': states,
+            'throughput_jobs_per_min': self.finished_total / uptime * 60 if uptime > 0 else 0.0,
+            'queue_latency_mean_s': sum(latencies) / len(latencies) if latencies else None,
+            'queue_latency_p95_s': latencies[math.ceil(0.95 * len(latencies)) - 1] if latencies else None,
+            'run_time_mean_s': sum(run_times) / len(run_times) if run_times else None,
+        }
+
+    def run(self):
+        # Each worker thread keeps its own SIFT detector warm across jobs
+        self.local.sift = self.pipeline.cv2.SIFT_create()
+        while True:
+            _, _, job_id = self.job_queue.get()
+            with self.lock:
+                job = self.jobs.get(job_id)
+                # Cancelled while queued (and possibly evicted since)
+                if job is None or job['state'] == 'cancelled':
+                    continue
+                job['state'] = 'running'
+                job['started_at'] = time.time()
+
+            def progress(message, job=job):
+                with self.lock:
+                    job['progress'].append(message.strip())
+
+            temp_dir = tempfile.mkdtemp(prefix=f"panorama_job{job_id}_")
+            # Concurrent jobs split the worker's thread budget
+            budget = ThreadBudget(self.threads_budget, jobs=self.num_workers)
+            try:
+                pano = self.pipeline.generate_panorama(job['video'], job['output'], temp_dir, job['engine'],
+                                                       progress=progress, sift=self.local.sift,
+                                                       optimize=job['optimize'], selector=job['selector'],
+                                                       neighbors=job['neighbors'], grid_cols=job['grid_cols'],
+                                                       budget=budget, cancel_event=self.cancel_events[job_id])
+                state = 'done' if pano is not None else 'failed'
+                error = None if pano is not None else job['progress'][-1]
+            except Exception as e:
+                state, error = 'failed', str(e)
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            # A cancel that arrived after the panorama was saved does not undo it
+            if self.cancel_events[job_id].is_set() and state != 'done':
+                state, error = 'cancelled', None
+
+            with self.lock:
+                job['state'] = state
+                job['error'] = error
+                job['finished_at'] = time.time()
+                if state in ('done', 'failed'):
+                    self.finished_total += 1
+                self.evict_finished()
+            print(f"Job {job_id} {state} in {job['finished_at'] - job['started_at']:.1f} seconds")
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Handles one JSON request per line"""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = self.dispatch(json.loads(line))
+            except KeyError as e:
+                reply = {'ok': False, 'error': f"Unknown job or missing field: {e}"}
+            except Exception as e:
+                reply = {'ok': False, 'error': str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+    def dispatch(self, request):
+        worker = self.server.worker
+        cmd = request.get('cmd')
+        if cmd == 'submit':
+            job_id = worker.submit(request['video'], request['output'],
+                                   request.get('engine', 'stitcher'), int(request.get('priority', 0)),
+                                   bool(request.get('optimize', False)), request.get('selector', 'sift'),
+                                   request.get('neighbors', 2), request.get('grid_cols'))
+            return {'ok': True, 'job_id': job_id}
+        if cmd == 'status':
+            return {'ok': True, 'job': worker.status(request['job_id'], int(request.get('since', 0)))}
+        if cmd == 'cancel':
+            return {'ok': True, 'state': worker.cancel(request['job_id'])}
+        if cmd == 'metrics':
+            return {'ok': True, 'metrics': worker.metrics()}
+        return {'ok': False, 'error': f"Unknown command: {cmd}"}
+
+
+def serve(address, num_workers=1, threads=None):
+    addr = parse_address(address)
+    if not isinstance(addr, tuple) and os.path.exists(addr):
+        # Only remove the socket if no worker is listening on it any more
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(addr)
+        except ConnectionRefusedError:
+            os.remove(addr)
+        else:
+            print(f"Another worker is already listening on {address}")
+            return
+
+    worker = PanoramaWorker(num_workers, threads)
+    worker.start()
+
+    if isinstance(addr, tuple):
+        server = socketserver.ThreadingTCPServer(addr, RequestHandler)
+    else:
+        server = socketserver.ThreadingUnixStreamServer(addr, RequestHandler)
+    server.daemon_threads = True
+    server.worker = worker
+
+    print(f"Panorama worker listening on {address} with {num_workers} worker thread(s), "
+          f"thread budget {worker.threads_budget}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down worker")
+    finally:
+        server.server_close()
+        if not isinstance(addr, tuple) and os.path.exists(addr):
+            os.remove(addr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Long-running panorama worker accepting jobs over a local socket')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='Unix socket path or host:port to listen on')
+    parser.add_argument('--workers', type=int, default=1, help='Number of jobs processed concurrently')
+    parser.add_argument('--threads', type=positive_int, default=None,
+                        help='Total thread budget shared by all jobs (default: CPUs available, respecting cgroup limits)')
+    parser.add_argument('--metrics', action='store_true', help='Print metrics of a running worker and exit')
+    args = parser.parse_args()
+
+    if args.metrics:
+        print(json.dumps(send_request(args.address, {'cmd': 'metrics'})['metrics'], indent=2))
+        return
+
+    serve(args.address, args.workers, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import argparse
+import math
+import os
+import time
+from contextlib import contextmanager
+
+import cv2
+
+# Pipeline stages that get their own thread allocation
+STAGES = ('decode', 'features', 'stitching', 'encoding')
+
+
+# Where the cgroup v2 hierarchy (or the v1 cpu controller) is usually mounted
+CGROUP_V2_MOUNTS = ('/sys/fs/cgroup', '/sys/fs/cgroup/unified')
+CGROUP_V1_CPU_MOUNTS = ('/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct')
+
+
+def cgroup_directories():
+    """Cgroup directories that may limit this process: its own v2 and v1 cpu cgroups from
+    /proc/self/cgroup and every parent up to the mount root"""
+    try:
+        with open('/proc/self/cgroup') as f:
+            entries = [line.rstrip('\n').split(':', 2) for line in f if line.count(':') >= 2]
+    except OSError:
+        entries = []
+    directories = []
+    for _, controllers, path in entries:
+        if controllers == '':
+            mounts = CGROUP_V2_MOUNTS
+        elif 'cpu' in controllers.split(','):
+            mounts = CGROUP_V1_CPU_MOUNTS
+        else:
+            continue
+        # Inside a cgroup namespace the path is '/', so this reduces to the mount root
+        parts = [part for part in path.split('/') if part]
+        for mount in mounts:
+            for depth in range(len(parts), -1, -1):
+                directory = os.path.join(mount, *parts[:depth])
+                if directory not in directories:
+                    directories.append(directory)
+    return directories or list(CGROUP_V2_MOUNTS + CGROUP_V1_CPU_MOUNTS)
+
+
+def read_cpu_limit(directory):
+    """CPU limit set on one cgroup directory (v2 cpu.max or v1 CFS quota), or None"""
+    try:
+        with open(os.path.join(directory, 'cpu.max')) as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return max(1, math.ceil(int(quota) / int(period)))
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(directory, 'cpu.cfs_quota_us')) as f:
+            quota = int(f.read())
+        with open(os.path.join(directory, 'cpu.cfs_period_us')) as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return max(1, math.ceil(quota / period))
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def cgroup_cpu_limit():
+    """Smallest CPU limit on this process's cgroup or any of its parents, or None if unlimited"""
+    limits = [read_cpu_limit(directory) for directory in cgroup_directories()]
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if limits else None
+
+
+def available_cpus():
+    """CPUs this process may actually use: affinity mask capped by the cgroup limit"""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    return min(cpus, limit) if limit else cpus
+
+
+def positive_int(value):
+    """argparse type for thread counts: a whole number of at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a whole number of at least 1, got {value!r}")
+    return number
+
+
+class ThreadBudget:
+    """Splits a thread budget between decode, feature extraction, stitching and encoding.
+
+    Stages of one job run one after another, so each stage may use the whole per-job
+    budget. `reserve` threads are kept free (e.g. for the GUI main loop) and `jobs`
+    concurrent jobs share what is left. cv2.setNumThreads is process-wide, so it is
+    only switched per stage when a single job runs; with concurrent jobs OpenCV's pool
+    is sized once for all of them.
+
+    Stage CPU times are process-wide (OpenCV's pool threads are not visible per thread),
+    so they also count concurrent jobs and other threads such as the GUI's; the CPU of
+    the calling thread alone is recorded next to them.
+    """
+
+    def __init__(self, total=None, jobs=1, reserve=0):
+        self.cpus = available_cpus()
+        self.total = max(1, total or self.cpus)
+        self.jobs = max(1, jobs)
+        self.reserve = min(reserve, self.total - 1)
+        per_job = max(1, (self.total - self.reserve) // self.jobs)
+        self.allocation = {
+            'decode': per_job,
+            'features': per_job,
+            'stitching': per_job,
+            # cv2.imwrite encodes on a single thread
+            'encoding': 1,
+        }
+        self.stats = {}
+        self.current_threads = None
+        if self.jobs > 1:
+            self.set_threads(self.total - self.reserve)
+            # OpenCV-parallel stages run on the shared pool, whatever their share of it
+            self.allocation['features'] = self.allocation['stitching'] = self.current_threads
+
+    def set_threads(self, threads):
+        # Resizing OpenCV's pool is not free, so only do it when the count changes
+        if threads != self.current_threads:
+            cv2.setNumThreads(threads)
+            self.current_threads = threads
+
+    def open_video(self, video_path):
+        """Open a video with the decode allocation where the backend supports it"""
+        if hasattr(cv2, 'CAP_PROP_N_THREADS'):
+            vid_cap = cv2.VideoCapture(video_path, cv2.CAP_ANY, [cv2.CAP_PROP_N_THREADS, self.allocation['decode']])
+            if vid_cap.isOpened():
+                return vid_cap
+        return cv2.VideoCapture(video_path)
+
+    @contextmanager
+    def stage(self, name):
+        """Run a block with the stage's OpenCV thread count and record its CPU usage"""
+        if self.jobs == 1:
+            self.set_threads(self.allocation[name])
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        thread_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu, thread_cpu = self.stats.get(name, (0.0, 0.0, 0.0))
+            self.stats[name] = (wall + time.perf_counter() - wall_start,
+                                cpu + time.process_time() - cpu_start,
+                                thread_cpu + time.thread_time() - thread_start)
+
+    def add_cpu(self, name, cpu):
+        """Count CPU time spent in a child process towards a stage"""
+        wall, total, thread_cpu = self.stats.get(name, (0.0, 0.0, 0.0))
+        self.stats[name] = (wall, total + cpu, thread_cpu)
+
+    def report(self):
+        """Lines describing the allocation and the CPU utilization actually achieved"""
+        limit = cgroup_cpu_limit()
+        allocation = ', '.join(f"{name}={self.allocation[name]}" for name in STAGES)
+        lines = [f"Thread allocation: {allocation} (budget {self.total} of {self.cpus} usable CPUs, "
+                 f"cgroup limit {limit or 'none'}, reserved {self.reserve}, {self.jobs} concurrent job(s))"]
+        if self.jobs > 1:
+            lines.append(f"  OpenCV pool of {self.current_threads} thread(s) shared by {self.jobs} jobs")
+        for name in STAGES:
+            if name not in self.stats:
+                continue
+            wall, cpu, thread_cpu = self.stats[name]
+            threads = self.allocation[name]
+            utilization = cpu / (wall * threads) * 100 if wall > 0 else 0.0
+            lines.append(f"  {name}: {wall:.1f}s wall, {cpu:.1f}s process CPU ({thread_cpu:.1f}s on this thread), "
+                         f"{utilization:.0f}% of {threads} thread(s)")
+        if self.jobs > 1 or self.reserve > 0:
+            lines.append("  Process CPU includes other jobs and threads running at the same time")
+        return lines